@@ -6,7 +6,9 @@ from flask import Flask, request, jsonify, make_response
 app = Flask(__name__)
 
 WA_SIGNING_SECRET = (os.getenv("WA_SIGNING_SECRET") or "").strip()
-PORTAL_WA_NUMBER  = re.sub(r"\D+", "", os.getenv("PORTAL_WA_NUMBER", "+96597273411")) or "96597273411"
+_WA_SECRET_BYTES  = WA_SIGNING_SECRET.encode("utf-8") if WA_SIGNING_SECRET else None
+_NONDIGIT = re.compile(r"\D+")
+PORTAL_WA_NUMBER  = _NONDIGIT.sub("", os.getenv("PORTAL_WA_NUMBER", "+96597273411")) or "96597273411"
 
 # (اختياري) Google Sheets analytics
 GS_WEBHOOK = os.getenv("GS_WEBHOOK", "").strip()
@@ -37,9 +39,12 @@ def wa_redirect(_path=""):
     sig = request.args.get("sig", "")
 
     # Verify HMAC signature لو متضبوطة
-    if WA_SIGNING_SECRET:
-        good = hmac.new(WA_SIGNING_SECRET.encode("utf-8"), t.encode("utf-8"), hashlib.sha256).hexdigest()
-        if not hmac.compare_digest(good, sig or ""):
+    if _WA_SECRET_BYTES is not None:
+        # cheap reject before any crypto: sha256 hexdigest is always 64 chars
+        if not t or len(sig) != 64:
+            return jsonify(ok=False, error="bad signature"), 403
+        good = hmac.new(_WA_SECRET_BYTES, t.encode("utf-8"), hashlib.sha256).hexdigest()
+        if not hmac.compare_digest(good, sig):
             return jsonify(ok=False, error="bad signature"), 403
 
     # فكّ التوكن
@@ -61,7 +66,9 @@ def wa_redirect(_path=""):
     except Exception:
         pass
 
-    wa  = re.sub(r"\D+", "", (data.get("wa") or "")) or PORTAL_WA_NUMBER
+    wa  = _NONDIGIT.sub("", (data.get("wa") or "")) or PORTAL_WA_NUMBER
+    if len(wa) > 20:  # no real phone number is this long
+        return jsonify(ok=False, error="bad token"), 400
     txt = data.get("text") or ""
     target = f"https://wa.me/{wa}?text={quote(txt)}"
 
@@ -1,12 +1,33 @@
 # api/webhook.py
-import os, json, re, time, html, traceback, base64, hmac, hashlib
+import os, sys, json, re, time, html, base64, hmac, hashlib, heapq
+import logging
+import queue
+import threading
+from logging.handlers import QueueHandler, QueueListener
+from collections import OrderedDict
+from functools import lru_cache
 from typing import Dict, Any, List, Tuple, Set
-from flask import Flask, request, jsonify
+from concurrent.futures import ThreadPoolExecutor
+from cachetools import TTLCache
+from flask import Flask, Response, request, jsonify
+import orjson
 import requests
+from requests.adapters import HTTPAdapter, Retry
 
 app = Flask(__name__)
 BUILD_TAG = "kuwait-igcse-portal-v3.1-final"
 
+# ------------ Logging ------------
+# Handlers write via a queue drained on a dedicated thread, so a slow
+# stdout pipe never stalls a webhook worker.
+_LOG_Q: "queue.Queue" = queue.Queue(-1)
+_LOG_STREAM = logging.StreamHandler(sys.stdout)
+_LOG_STREAM.setFormatter(logging.Formatter("%(levelname)s %(message)s"))
+log = logging.getLogger("webhook")
+log.setLevel(logging.DEBUG if app.debug else logging.INFO)
+log.addHandler(QueueHandler(_LOG_Q))
+QueueListener(_LOG_Q, _LOG_STREAM).start()
+
 # ------------ Telegram basics ------------
 TELEGRAM_TOKEN = (os.getenv("TELEGRAM_BOT_TOKEN") or "").strip()
 BOT_USERNAME   = (os.getenv("BOT_USERNAME") or "").lstrip("@").strip()
@@ -16,34 +37,109 @@ TELEGRAM_WEBHOOK_SECRET = (os.getenv("TELEGRAM_WEBHOOK_SECRET") or "").strip()
 ADMIN_LOG_CHAT_ID = (os.getenv("ADMIN_LOG_CHAT_ID") or "").strip()
 LOG_RAW_UPDATES = (os.getenv("LOG_RAW_UPDATES") or "0").strip().lower() in ("1", "true", "yes")
 
+# Pooled keep-alive session so tg() reuses TCP/TLS connections instead of
+# paying a fresh handshake per call.
+TG_SESSION = requests.Session()
+TG_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=16, pool_maxsize=64,
+    max_retries=Retry(total=2, backoff_factor=0.2),
+))
+_JSON_HEADERS = {"Content-Type": "application/json"}
+
+def _warm_tg_connection():
+    # pay DNS + TLS for api.telegram.org during cold start, off the
+    # request path, so the first real tg() call finds a pooled socket
+    try:
+        TG_SESSION.get(f"{BOT_API}/getMe", timeout=(3, 8))
+    except Exception:
+        pass
+
+if BOT_API:
+    threading.Thread(target=_warm_tg_connection, daemon=True).start()
+
+def _resp_json(r) -> Dict[str, Any]:
+    try:
+        j = orjson.loads(r.content)
+        return j if isinstance(j, dict) else {}
+    except Exception:
+        return {}
+
+class TokenBucket:
+    """Blocking token bucket; acquire() sleeps until a token is available."""
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+# Telegram allows ~30 msg/s overall and ~1 msg/s sustained per chat;
+# stay just under so bursts never trigger 429 backoff cycles.
+_TG_GLOBAL_BUCKET = TokenBucket(rate=29, capacity=29)
+_TG_CHAT_BUCKETS: "TTLCache[Any, TokenBucket]" = TTLCache(maxsize=4096, ttl=300)
+_TG_CHAT_LOCK = threading.Lock()
+
+def _chat_bucket(chat_id) -> TokenBucket:
+    with _TG_CHAT_LOCK:
+        b = _TG_CHAT_BUCKETS.get(chat_id)
+        if b is None:
+            b = TokenBucket(rate=1, capacity=3)  # small burst allowance
+            _TG_CHAT_BUCKETS[chat_id] = b
+        return b
+
+def _acquire_tg_buckets(method: str, payload: Dict[str, Any]):
+    _TG_GLOBAL_BUCKET.acquire()
+    # Telegram's ~1 msg/s per-chat guidance covers sending messages;
+    # edits/acks aren't counted, and throttling them would make every
+    # subject toggle wait a blocking second.
+    chat_id = payload.get("chat_id")
+    if chat_id is not None and method.startswith("send"):
+        _chat_bucket(chat_id).acquire()
+
 def tg(method: str, payload: Dict[str, Any]):
     if not BOT_API:
-        print(f"[TG] skip {method} (no token)")
+        log.info("[TG] skip %s (no token)", method)
         return None
     try:
-        r = requests.post(f"{BOT_API}/{method}", json=payload, timeout=20)
-        try:
-            j = r.json()
-        except Exception:
-            j = {}
+        body = orjson.dumps(payload)
+        _acquire_tg_buckets(method, payload)
+        r = TG_SESSION.post(f"{BOT_API}/{method}", data=body, headers=_JSON_HEADERS, timeout=(3, 8))
+        j = _resp_json(r)
+        if r.status_code == 429:
+            retry_after = (j.get("parameters") or {}).get("retry_after", 1)
+            log.warning("[TG 429] %s retry_after=%s", method, retry_after)
+            time.sleep(min(retry_after, 10))
+            # re-enter the limiter for the retry — Telegram just told us
+            # we're over budget, so don't bypass it now
+            _acquire_tg_buckets(method, payload)
+            r = TG_SESSION.post(f"{BOT_API}/{method}", data=body, headers=_JSON_HEADERS, timeout=(3, 8))
+            j = _resp_json(r)
         if r.status_code != 200 or (isinstance(j, dict) and not j.get("ok", True)):
-            print(f"[TG ERR] {method} {r.status_code} -> {r.text[:500]}")
+            log.warning("[TG ERR] %s %s -> %s", method, r.status_code, r.text[:500])
         else:
-            print(f"[TG OK] {method}")
+            log.debug("[TG OK] %s", method)
         return r
     except Exception as e:
-        print("[TG EXC]", method, repr(e))
+        log.warning("[TG EXC] %s %r", method, e)
         return None
 
 def tg_edit_or_send(chat_id: int, message_id: int, text: str, reply_markup=None, parse_mode="HTML"):
     payload = {"chat_id": chat_id, "message_id": message_id, "text": text[:4096], "parse_mode": parse_mode, "reply_markup": reply_markup}
     r = tg("editMessageText", payload)
-    ok = False
-    try:
-        j = r.json() if r is not None else {}
-        ok = (r is not None) and (r.status_code == 200) and (isinstance(j, dict) and j.get("ok", True))
-    except Exception:
-        ok = False
+    j = _resp_json(r) if r is not None else {}
+    ok = (r is not None) and (r.status_code == 200) and j.get("ok", True)
     if not ok:
         tg("sendMessage", {"chat_id": chat_id, "text": text[:4096], "parse_mode": parse_mode, "reply_markup": reply_markup})
 
@@ -53,7 +149,8 @@ def admin_log(text: str):
     tg("sendMessage", {"chat_id": ADMIN_LOG_CHAT_ID, "text": text[:4000]})
 
 # ------------ Config ------------
-PORTAL_WA_NUMBER = re.sub(r"\D+", "", os.getenv("PORTAL_WA_NUMBER", "+96597273411")) or "96597273411"
+_NONDIGIT = re.compile(r"\D+")
+PORTAL_WA_NUMBER = _NONDIGIT.sub("", os.getenv("PORTAL_WA_NUMBER", "+96597273411")) or "96597273411"
 PUBLIC_BASE_URL  = (os.getenv("PUBLIC_BASE_URL", "https://kuwait-igcse-portal.vercel.app") or "").rstrip("/")
 
 # Optional WA redirect HMAC
@@ -63,28 +160,59 @@ WA_SIGNING_SECRET = (os.getenv("WA_SIGNING_SECRET") or "").strip() or None
 GS_WEBHOOK = os.getenv("GS_WEBHOOK", "").strip()  # مثال: https://script.google.com/macros/s/AKfycb.../exec
 GS_SECRET  = os.getenv("GS_SECRET", "").strip()
 
+# Events are queued here and bulk-flushed by a daemon thread, so the
+# webhook path pays a put_nowait instead of a synchronous HTTP POST.
+EVENT_Q: "queue.Queue[dict]" = queue.Queue(maxsize=10000)
+_EVENTS_DROPPED = 0
+
 def push_event(event_type: str, payload: dict):
+    global _EVENTS_DROPPED
     if not (GS_WEBHOOK and GS_SECRET):
         return
     rec = {
         "ts": int(time.time()),
         "event": event_type,
         **payload,
-        "_secret": GS_SECRET
     }
     try:
-        requests.post(GS_WEBHOOK, json=rec, timeout=4)
-    except Exception as e:
-        print("[ANALYTICS] push_event failed:", repr(e))
+        EVENT_Q.put_nowait(rec)
+    except queue.Full:
+        _EVENTS_DROPPED += 1
+
+def _drain_events():
+    dropped_reported = 0
+    while True:
+        batch = [EVENT_Q.get()]
+        if _EVENTS_DROPPED != dropped_reported:
+            log.warning("[ANALYTICS] %d events dropped so far (queue full)", _EVENTS_DROPPED)
+            dropped_reported = _EVENTS_DROPPED
+        t0 = time.monotonic()
+        while len(batch) < 200 and time.monotonic() - t0 < 0.2:
+            try:
+                batch.append(EVENT_Q.get(timeout=0.05))
+            except queue.Empty:
+                break
+        try:
+            if len(batch) == 1:
+                rec = {**batch[0], "_secret": GS_SECRET}
+            else:
+                # the Apps Script unpacks _batch envelopes into rows
+                rec = {"ts": int(time.time()), "event": "_batch", "events": batch, "_secret": GS_SECRET}
+            requests.post(GS_WEBHOOK, json=rec, timeout=4)
+        except Exception as e:
+            log.warning("[ANALYTICS] flush failed: %r", e)
+
+if GS_WEBHOOK and GS_SECRET:
+    threading.Thread(target=_drain_events, daemon=True, name="event-flusher").start()
 
 # ------------ Load data ------------
 DATA_PATH = os.path.join(os.path.dirname(__file__), "teachers.json")
 try:
-    with open(DATA_PATH, "r", encoding="utf-8") as f:
-        TEACHERS = json.load(f)
-    print(f"Loaded {len(TEACHERS)} teachers from {DATA_PATH}.")
+    with open(DATA_PATH, "rb") as f:
+        TEACHERS = orjson.loads(f.read())
+    log.info("Loaded %d teachers from %s.", len(TEACHERS), DATA_PATH)
 except Exception as e:
-    print(f"ERROR loading teachers.json: {e}")
+    log.error("ERROR loading teachers.json: %s", e)
     TEACHERS = []
 
 # ------------ Subjects (Extended + AS/A) ------------
@@ -194,11 +322,24 @@ CODE_TO_SUBJECT = {
 BOARD_CODES = {"C": "Cambridge", "E": "Edexcel", "O": "OxfordAQA"}
 
 # ------------ Helpers ------------
+# single-pass C-level escape; covers html.escape's quote=True set
+_HTML_ESCAPE_TABLE = str.maketrans({
+    "&": "&amp;", "<": "&lt;", ">": "&gt;", '"': "&quot;", "'": "&#x27;",
+})
+
 def h(x: str) -> str:
-    return html.escape(x or "")
+    return (x or "").translate(_HTML_ESCAPE_TABLE)
 
+# subject names are trusted but not markup-safe ("Travel & Tourism");
+# escape them once here so hot renders can skip h()
+CODE_TO_SUBJECT_HTML = {c: h(n) for c, n in CODE_TO_SUBJECT.items()}
+
+_WS_RE = re.compile(r"\s+")
+
+@lru_cache(maxsize=4096)
 def _norm(s: str) -> str:
-    return re.sub(r"\s+", " ", (s or "")).strip().lower()
+    # split/join collapses all whitespace without invoking the regex engine
+    return " ".join((s or "").split()).lower()
 
 def _nice_subject_name(key: str) -> str:
     nice = {
@@ -223,21 +364,37 @@ def _nice_subject_name(key: str) -> str:
     }
     return nice.get(key, key.title())
 
+# Normalized alias pools, built once at import so canonical_subject doesn't
+# re-normalize the whole dictionary on every call.
+_VS_POOL_NORM: Dict[str, List[str]] = {
+    k: [_norm(x) for x in [k] + aliases] for k, aliases in VALID_SUBJECTS.items()
+}
+
+_SUBJ_CLEAN_RE = re.compile(r"[^a-z0-9\s&()/-]+")
+
+# exact-lookup table plus precompiled word-boundary patterns, built once
+# so canonical_subject is a dict hit on the hot path instead of a regex scan
+ALIAS_TO_CANONICAL: Dict[str, str] = {}
+_ALIAS_PATTERNS: List[Tuple["re.Pattern[str]", str]] = []
+for canonical, pool_norm in _VS_POOL_NORM.items():
+    nice = sys.intern(_nice_subject_name(canonical.lower()))
+    for alias in pool_norm:
+        ALIAS_TO_CANONICAL.setdefault(alias, nice)
+        _ALIAS_PATTERNS.append((re.compile(rf"\b{re.escape(alias)}\b"), nice))
+
+@lru_cache(maxsize=512)
 def canonical_subject(label: str) -> str | None:
     t = _norm(label)
     if not t:
         return None
-    t_clean = re.sub(r"[^a-z0-9\s&()/-]+", " ", t)
-    t_clean = re.sub(r"\s+", " ", t_clean).strip()
-    for canonical, aliases in VALID_SUBJECTS.items():
-        pool = [canonical] + aliases
-        pool_norm = [_norm(x) for x in pool]
-        if any(t_clean == p for p in pool_norm):
-            return _nice_subject_name(canonical.lower())
-        for alias in pool_norm:
-            if re.search(rf"\b{re.escape(alias)}\b", t_clean):
-                return _nice_subject_name(canonical.lower())
-    print("[WARN] canonical_subject: no match for", label)
+    t_clean = _WS_RE.sub(" ", _SUBJ_CLEAN_RE.sub(" ", t)).strip()
+    hit = ALIAS_TO_CANONICAL.get(t_clean)
+    if hit is not None:
+        return hit
+    for pat, nice in _ALIAS_PATTERNS:
+        if pat.search(t_clean):
+            return nice
+    log.warning("[WARN] canonical_subject: no match for %s", label)
     return None
 
 def teacher_has_subject(teacher_subjects: List[str], wanted_label: str) -> bool:
@@ -251,15 +408,30 @@ def teacher_has_subject(teacher_subjects: List[str], wanted_label: str) -> bool:
             return True
     return False
 
+_BOARD_ALIASES = {
+    "o": "oxfordaqa", "oxford": "oxfordaqa", "oxfordaqa": "oxfordaqa", "oxford aqa": "oxfordaqa",
+    "c": "cambridge", "cambridge": "cambridge",
+    "e": "edexcel", "edexcel": "edexcel", "pearson edexcel": "edexcel", "pearson": "edexcel",
+}
+
 def canonical_board(label: str) -> str:
     t = _norm(label)
-    if t in ("o", "oxford", "oxfordaqa", "oxford aqa"):
-        return "oxfordaqa"
-    if t in ("c", "cambridge"):
-        return "cambridge"
-    if t in ("e", "edexcel", "pearson edexcel", "pearson"):
-        return "edexcel"
-    return t or ""
+    return _BOARD_ALIASES.get(t, t or "")
+
+def _render_teacher_caption(t: Dict[str, Any]) -> str:
+    quals = ", ".join(t.get("qualifications", []) or [])
+    boards = ", ".join(t.get("boards", []) or [])
+    grades = ""
+    if t.get("grades"):
+        gmin, gmax = min(t["grades"]), max(t["grades"])
+        grades = f"Grades {gmin}-{gmax}"
+    lines = [
+        f"<b>{h(t.get('name','Tutor'))}</b> — {h(', '.join(t.get('_subjects_display') or t.get('subjects', [])))}",
+        "  " + " | ".join([x for x in ([h(grades)] if grades else []) + ([f"Boards {h(boards)}"] if boards else []) if x]),
+    ]
+    if t.get("bio"):      lines.append("  " + h(t["bio"]))
+    if quals:             lines.append("  " + f"Qualifications: {h(quals)}")
+    return "\n".join(lines)
 
 # Precompute canonical fields on teachers
 for t in TEACHERS:
@@ -272,31 +444,50 @@ for t in TEACHERS:
         c = canonical_subject(s)
         if c:
             t["_subjects_canon"].add(c)
-    t["_boards_canon"] = [canonical_board(b) for b in (t.get("boards") or [])]
+    t["_boards_canon"] = {sys.intern(canonical_board(b)) for b in (t.get("boards") or [])}
+    t["_grades_set"] = set(t.get("grades") or [])
+    # caption depends only on the teacher record; render it once here
+    t["_caption_html"] = _render_teacher_caption(t)
+
+# inverted index: canonical subject -> teachers who teach it, so matching
+# only walks the relevant bucket instead of every teacher
+SUBJECT_INDEX: Dict[str, List[Dict[str, Any]]] = {}
+for t in TEACHERS:
+    for s in t["_subjects_canon"]:
+        SUBJECT_INDEX.setdefault(s, []).append(t)
 
 def match_teachers(subject=None, grade=None, board=None, limit=4):
     board_can = canonical_board(board) if board else ""
+    if subject:
+        wanted = canonical_subject(subject)
+        candidates = SUBJECT_INDEX.get(wanted, []) if wanted else []
+    else:
+        candidates = TEACHERS
     results = []
     debug_why = []
-    for t in TEACHERS:
+    for t in candidates:
         why = {"teacher": t.get("name"), "ok": True, "reasons": []}
-        if subject and not teacher_has_subject(t.get("subjects", []), subject):
-            why["ok"] = False; why["reasons"].append(f"subject_mismatch: wanted={subject}, teacher_subjects={t.get('subjects')}")
         if grade is not None:
-            grades = t.get("grades") or []
-            if grade not in grades:
-                why["ok"] = False; why["reasons"].append(f"grade_mismatch: wanted={grade}, teacher_grades={grades}")
+            if grade not in t["_grades_set"]:
+                why["ok"] = False; why["reasons"].append(f"grade_mismatch: wanted={grade}, teacher_grades={t.get('grades')}")
         if board_can:
-            if board_can not in (t.get("_boards_canon") or []):
-                why["ok"] = False; why["reasons"].append(f"board_mismatch: wanted_can={board_can}, teacher_can={t.get('_boards_canon')}")
+            if board_can not in t["_boards_canon"]:
+                why["ok"] = False; why["reasons"].append(f"board_mismatch: wanted_can={board_can}, teacher_can={sorted(t['_boards_canon'])}")
         if why["ok"]:
             results.append(t)
         else:
             debug_why.append(why)
     if not results:
-        print("[DEBUG NO MATCH]", json.dumps(debug_why[:5], ensure_ascii=False))
-    results.sort(key=lambda tt: tt.get("name", "").lower())
-    return results[:limit]
+        log.debug("[DEBUG NO MATCH] %s", json.dumps(debug_why[:5], ensure_ascii=False))
+    # partial selection: only the first `limit` names are needed, so skip
+    # sorting the full result list
+    return heapq.nsmallest(limit, results, key=lambda tt: tt.get("name", "").lower())
+
+@lru_cache(maxsize=2048)
+def _matches_cached(subjects_key: Tuple[str, ...], grade: int, board: str) -> Tuple[Dict[str, Any], ...]:
+    # TEACHERS is static for the life of the process, so identical
+    # (subjects, grade, board) queries can skip the full scan.
+    return tuple(collect_best_matches(list(subjects_key), grade, board, k=4))
 
 def collect_best_matches(subjects: List[str], grade: int, board: str, k: int = 4) -> List[Dict[str, Any]]:
     seen, out = set(), []
@@ -317,7 +508,7 @@ def build_wa_redirect_link(user_id, username, teacher_id, wa_number, prefill_tex
         "user_id": user_id,
         "username": username or "",
         "teacher_id": teacher_id,
-        "wa": re.sub(r"\D+", "", wa_number or "") or PORTAL_WA_NUMBER,
+        "wa": PORTAL_WA_NUMBER if not wa_number else (_NONDIGIT.sub("", wa_number) or PORTAL_WA_NUMBER),
         "text": prefill_text
     }
     t = base64.urlsafe_b64encode(json.dumps(payload, ensure_ascii=False).encode()).decode().rstrip("=")
@@ -328,21 +519,6 @@ def build_wa_redirect_link(user_id, username, teacher_id, wa_number, prefill_tex
     return f"{base}/api/wa?t={t}"
 
 # ------------ Keyboards & rendering ------------
-def format_teacher_caption_html(t: Dict[str,Any], student_full_name: str, board: str, grade: int, subjects: List[str]) -> str:
-    quals = ", ".join(t.get("qualifications", []) or [])
-    boards = ", ".join(t.get("boards", []) or [])
-    grades = ""
-    if t.get("grades"):
-        gmin, gmax = min(t["grades"]), max(t["grades"])
-        grades = f"Grades {gmin}-{gmax}"
-    lines = [
-        f"<b>{h(t.get('name','Tutor'))}</b> — {h(', '.join(t.get('_subjects_display') or t.get('subjects', [])))}",
-        "  " + " | ".join([x for x in ([h(grades)] if grades else []) + ([f"Boards {h(boards)}"] if boards else []) if x]),
-    ]
-    if t.get("bio"):      lines.append("  " + h(t["bio"]))
-    if quals:             lines.append("  " + f"Qualifications: {h(quals)}")
-    return "\n".join(lines)
-
 def kb_with_restart(markup: Dict[str, Any] | None) -> Dict[str, Any]:
     if not markup:
         markup = {"inline_keyboard": []}
@@ -350,12 +526,6 @@ def kb_with_restart(markup: Dict[str, Any] | None) -> Dict[str, Any]:
     rows.append([{"text": "⟲ Restart", "callback_data": "FORCE_RESTART"}])
     return {"inline_keyboard": rows}
 
-def encode_sel(sel: Set[str]) -> str:
-    return ".".join(sorted(sel)) if sel else ""
-
-def decode_sel(s: str) -> Set[str]:
-    return set([x for x in s.split(".") if x])
-
 def kb_board():
     return {"inline_keyboard": [[
         {"text": "Cambridge", "callback_data": "B|C"},
@@ -373,31 +543,46 @@ def kb_grade(board_code: str):
     rows.append([{"text": "⬅️ Back", "callback_data": "B|"+board_code}])
     return {"inline_keyboard": rows}
 
-def kb_subjects(board_code: str, grade: int, sel: Set[str]):
+@lru_cache(maxsize=64)
+def _kb_subjects_skeleton(board_code: str, grade: int):
+    # Static per-(board, grade) layout; selection ticks are overlaid per call.
     rows = []
-    def tick(code): return "✅" if code in sel else "☐"
+    toggles = []  # (row_idx, col_idx, code, label)
     for group, items in SUBJECT_GROUPS.items():
         rows.append([{"text": f"— {group} —", "callback_data": "noop"}])
         for i in range(0, len(items), 2):
             row = []
             for code, label in items[i:i+2]:
+                toggles.append((len(rows), len(row), code, label))
+                # board/grade are reconstructed from the session on receipt
                 row.append({
-                    "text": f"{tick(code)} {label}",
-                    "callback_data": f"T|{code}|{board_code}|{grade}|{encode_sel(sel)}"
+                    "text": f"☐ {label}",
+                    "callback_data": f"T|{code}"
                 })
             rows.append(row)
     rows.append([
-        {"text": "Done ✅", "callback_data": f"D|{board_code}|{grade}|{encode_sel(sel)}"},
-        {"text": "Reset ↩️", "callback_data": f"T|__RESET__|{board_code}|{grade}|{encode_sel(sel)}"},
+        {"text": "Done ✅", "callback_data": "D|"},
+        {"text": "Reset ↩️", "callback_data": "T|__RESET__"},
     ])
     rows.append([{"text": "⬅️ Back", "callback_data": f"G|{grade}|{board_code}"}])
-    return {"inline_keyboard": rows}
+    return rows, tuple(toggles)
+
+def kb_subjects(board_code: str, grade: int, sel: Set[str]):
+    # Selection state lives in the session; callback_data carries only the
+    # subject code + context so it stays well under Telegram's 64-byte cap.
+    rows, toggles = _kb_subjects_skeleton(board_code, grade)
+    out = [list(r) for r in rows]
+    for ri, ci, code, label in toggles:
+        if code in sel:
+            out[ri][ci] = {"text": f"✅ {label}", "callback_data": out[ri][ci]["callback_data"]}
+    return {"inline_keyboard": out}
 
 def summary_text(board_code: str, grade: int, sel: Set[str]) -> str:
+    # board names are markup-free; subject names use the pre-escaped table
     board = BOARD_CODES.get(board_code, board_code)
-    chosen = ", ".join(h(CODE_TO_SUBJECT[c]) for c in sorted(sel)) if sel else "—"
+    chosen = ", ".join(CODE_TO_SUBJECT_HTML[c] for c in sorted(sel)) if sel else "—"
     return (f"<b>Step 3/3 – Subjects</b>\n"
-            f"Board: <b>{h(board)}</b>   |   Grade: <b>{grade}</b>\n"
+            f"Board: <b>{board}</b>   |   Grade: <b>{grade}</b>\n"
             f"Pick one or more subjects, then press <b>Done</b>.\n"
             f"Selected: {chosen}")
 
@@ -433,30 +618,161 @@ def kb_select_teachers(matches: List[Dict[str, Any]], selected_ids: Set[str]):
     rows.append([{"text": "➕ Add more subjects", "callback_data": "ADD_MORE"}])
     return {"inline_keyboard": rows}
 
+# Fully static keyboards, built once at import instead of per request.
+KB_RESTART_ONLY = kb_with_restart({"inline_keyboard": []})
+KB_BOARD = kb_with_restart(kb_board())
+KB_MODE  = kb_mode()
+KB_LPW   = kb_lpw()
+KB_GRADE = {b: kb_with_restart(kb_grade(b)) for b in BOARD_CODES}
+
 # ------------ Sessions & idempotency ------------
-SESSIONS: Dict[int, Dict[str, Any]] = {}
-RECENT_DONE: Dict[int, List[Tuple[str, float]]] = {}
+SESSION_TTL = 3600
+REDIS_URL = (os.getenv("REDIS_URL") or "").strip()
+
+class TTLSessionStore:
+    """In-process store, bounded so memory stays capped per instance.
+
+    TTLCache is not thread-safe and updates are handled on a worker
+    pool, so all access goes through a lock.
+    """
+    _DONE_MAX = 4096
+
+    def __init__(self, maxsize: int = 5000, ttl: int = SESSION_TTL):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._seen_updates = TTLCache(maxsize=10000, ttl=600)
+        # (chat_id, signature) -> expiry; insertion-ordered so expired
+        # entries sweep from the front without scanning
+        self._done: "OrderedDict[Tuple[int, str], float]" = OrderedDict()
+        self._lock = threading.RLock()
+
+    def seen_update(self, update_id: int) -> bool:
+        with self._lock:
+            if update_id in self._seen_updates:
+                return True
+            self._seen_updates[update_id] = True
+            return False
+
+    def get(self, chat_id: int):
+        with self._lock:
+            return self._cache.get(chat_id)
+
+    def put(self, chat_id: int, sess: Dict[str, Any]):
+        with self._lock:
+            self._cache[chat_id] = sess
+
+    def toggle_teacher(self, chat_id: int, sess: Dict[str, Any], tid: str) -> Set[str]:
+        with self._lock:
+            sel = sess.setdefault("selected_teachers", set())
+            if tid in sel:
+                sel.remove(tid)
+            else:
+                sel.add(tid)
+            self._cache[chat_id] = sess
+            return sel
+
+    def already_done(self, chat_id: int, signature: str, ttl: int = 300) -> bool:
+        now = time.time()
+        key = (chat_id, signature)
+        with self._lock:
+            expiry = self._done.get(key)
+            if expiry is not None and now < expiry:
+                return True
+            self._done[key] = now + ttl
+            self._done.move_to_end(key)
+            while self._done and (len(self._done) > self._DONE_MAX
+                                  or next(iter(self._done.values())) <= now):
+                self._done.popitem(last=False)
+        return False
+
+class RedisSessionStore:
+    """Redis-backed store: survives cold starts, shared across instances."""
+    def __init__(self, url: str, ttl: int = SESSION_TTL):
+        import redis  # optional dep, only needed when REDIS_URL is set
+        self._r = redis.Redis.from_url(url)
+        self._ttl = ttl
+
+    @staticmethod
+    def _key(chat_id: int) -> str:
+        return f"s:{chat_id}"
+
+    def seen_update(self, update_id: int) -> bool:
+        # SETNX: False (fresh) when the key was newly set
+        return not self._r.set(f"upd:{update_id}", b"1", nx=True, ex=600)
+
+    _SET_KEYS = ("current_selection",)
+
+    def _teachers_key(self, chat_id: int) -> str:
+        return f"{self._key(chat_id)}:teachers"
+
+    def get(self, chat_id: int):
+        raw = self._r.get(self._key(chat_id))
+        if raw is None:
+            return None
+        sess = json.loads(raw)
+        # sets don't survive JSON; coerce back at the boundary
+        for k in self._SET_KEYS:
+            if isinstance(sess.get(k), list):
+                sess[k] = set(sess[k])
+        # selected_teachers lives in a companion Redis SET
+        sess["selected_teachers"] = {m.decode() for m in self._r.smembers(self._teachers_key(chat_id))}
+        return sess
+
+    def put(self, chat_id: int, sess: Dict[str, Any]):
+        out = dict(sess)
+        for k in self._SET_KEYS:
+            if isinstance(out.get(k), set):
+                out[k] = sorted(out[k])
+        teachers = out.pop("selected_teachers", None)
+        pipe = self._r.pipeline()
+        pipe.set(self._key(chat_id), json.dumps(out, ensure_ascii=False), ex=self._ttl)
+        if teachers is not None:
+            tkey = self._teachers_key(chat_id)
+            pipe.delete(tkey)
+            if teachers:
+                pipe.sadd(tkey, *teachers)
+            pipe.expire(tkey, self._ttl)
+        pipe.execute()
+
+    def toggle_teacher(self, chat_id: int, sess: Dict[str, Any], tid: str) -> Set[str]:
+        # single SADD/SREM instead of rewriting the whole session blob
+        tkey = self._teachers_key(chat_id)
+        if self._r.srem(tkey, tid) == 0:
+            self._r.sadd(tkey, tid)
+        self._r.expire(tkey, self._ttl)
+        sel = {m.decode() for m in self._r.smembers(tkey)}
+        sess["selected_teachers"] = sel
+        return sel
+
+    def already_done(self, chat_id: int, signature: str, ttl: int = 300) -> bool:
+        # SET NX is atomic, so the dedupe holds across replicas too
+        return not self._r.set(f"done:{chat_id}:{signature}", b"1", nx=True, ex=ttl)
+
+def _make_store():
+    if REDIS_URL:
+        # REDIS_URL is an explicit opt-in to shared sessions; degrading to
+        # the per-process store would silently lose state between workers,
+        # so let a missing redis package or bad URL fail the boot instead.
+        return RedisSessionStore(REDIS_URL)
+    return TTLSessionStore()
+
+STORE = _make_store()
 
 def session(chat_id: int) -> Dict[str, Any]:
-    if chat_id not in SESSIONS:
-        SESSIONS[chat_id] = {
+    s = STORE.get(chat_id)
+    if s is None:
+        s = {
             "stage": "idle",
             "name": "",
             "selections": [],
         }
-    return SESSIONS[chat_id]
+        STORE.put(chat_id, s)
+    return s
+
+def save_session(chat_id: int, s: Dict[str, Any]):
+    STORE.put(chat_id, s)
 
 def already_done(chat_id: int, signature: str, ttl: int = 300) -> bool:
-    now = time.time()
-    lst = RECENT_DONE.get(chat_id, [])
-    lst = [(k, t) for (k, t) in lst if now - t < ttl]
-    RECENT_DONE[chat_id] = lst
-    for k, _ in lst:
-        if k == signature:
-            return True
-    lst.append((signature, now))
-    RECENT_DONE[chat_id] = lst
-    return False
+    return STORE.already_done(chat_id, signature, ttl)
 
 # ------------ Security check for Telegram webhook ------------
 def _check_telegram_secret():
@@ -465,7 +781,7 @@ def _check_telegram_secret():
     sec = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
     ok = hmac.compare_digest(sec, TELEGRAM_WEBHOOK_SECRET)
     if not ok:
-        print("[WEBHOOK] bad secret header")
+        log.warning("[WEBHOOK] bad secret header")
     return ok
 
 # ------------ Routes ------------
@@ -473,342 +789,411 @@ def _check_telegram_secret():
 def ping():
     return jsonify(ok=True, build=BUILD_TAG, teachers=len(TEACHERS), bot=bool(BOT_API))
 
-def _handle_webhook():
-    if not _check_telegram_secret():
-        return jsonify(ok=False, error="forbidden"), 403
-    try:
-        update = request.get_json(force=True, silent=True) or {}
-        if LOG_RAW_UPDATES:
-            admin_log(f"RAW UPDATE: {json.dumps(update)[:3500]}")
+EXECUTOR = ThreadPoolExecutor(max_workers=32)
+
+# Outbound Telegram traffic gets its own pool: update handlers running on
+# EXECUTOR block on their sends (rate-limit sleeps included), so fanning
+# the sends out on the same pool could starve it into a deadlock once
+# every worker is a waiting parent.
+SEND_EXECUTOR = ThreadPoolExecutor(max_workers=16)
+
+def tg_async(method: str, payload: Dict[str, Any]):
+    """Fire-and-forget tg() for calls whose result never shapes the flow."""
+    SEND_EXECUTOR.submit(tg, method, payload)
+
+# Every ack is the same two-byte-payload 200; build it once.
+OK_RESPONSE = Response(orjson.dumps({"ok": True}), mimetype="application/json")
+
+def _cb_noop(cq, chat_id, msg_id, payload, user_id, username):
+    return
+
+def _cb_restart(cq, chat_id, msg_id, payload, user_id, username):
+    save_session(chat_id, {"stage": "ask_name", "name": "", "selections": []})
+    tg("sendMessage", {
+        "chat_id": chat_id,
+        "text": "👋 Welcome to Kuwait IGCSE Portal!\nPlease type your full name (student):",
+        "reply_markup": KB_RESTART_ONLY
+    })
+    push_event("restart", {"user_id": user_id, "username": username})
+
+def _cb_board(cq, chat_id, msg_id, payload, user_id, username):
+    b = payload
+    s = session(chat_id)
+    s["board_code"] = b
+    s["current_selection"] = set()
+    save_session(chat_id, s)
+    push_event("board", {"user_id": user_id, "username": username, "board": BOARD_CODES.get(b,b)})
+
+    if isinstance(s.get("grade"), int):
+        g = s["grade"]
+        sel = s["current_selection"]
+        tg_edit_or_send(chat_id, msg_id,
+            summary_text(b, g, sel),
+            reply_markup=kb_with_restart(kb_subjects(b, g, sel))
+        )
+        return
+
+    tg_edit_or_send(chat_id, msg_id,
+        "🔢 <b>Step 2/3 – Grade</b>\nSelect your current grade:",
+        reply_markup=KB_GRADE[b]
+    )
+
+def _cb_grade(cq, chat_id, msg_id, payload, user_id, username):
+    g, b = payload.split("|", 1)
+    g = int(g)
+    s = session(chat_id)
+    s["board_code"] = b
+    s["grade"] = g
+    s["current_selection"] = set()
+    save_session(chat_id, s)
+    sel = s["current_selection"]
+    push_event("grade", {"user_id": user_id, "username": username, "board": BOARD_CODES.get(b,b), "grade": g})
+    tg_edit_or_send(chat_id, msg_id,
+        summary_text(b, g, sel),
+        reply_markup=kb_with_restart(kb_subjects(b, g, sel))
+    )
+
+def _cb_toggle(cq, chat_id, msg_id, payload, user_id, username):
+    code = payload
+    if code != "__RESET__" and code not in CODE_TO_SUBJECT:
+        # stale pre-deploy keyboard or crafted data; don't poison the session
+        return
+    s = session(chat_id)
+    b, g = s.get("board_code"), s.get("grade")
+    if not b or not isinstance(g, int):
+        # session expired mid-flow; restart cleanly
+        _cb_restart(cq, chat_id, msg_id, payload, user_id, username)
+        return
+    sel = s.setdefault("current_selection", set())
+    if code == "__RESET__":
+        sel = set()
+    else:
+        if code in sel: sel.remove(code)
+        else: sel.add(code)
+    s["current_selection"] = sel
+    save_session(chat_id, s)
+    tg_edit_or_send(chat_id, msg_id,
+        summary_text(b, g, sel),
+        reply_markup=kb_with_restart(kb_subjects(b, g, sel))
+    )
+
+def _cb_done(cq, chat_id, msg_id, payload, user_id, username):
+    s = session(chat_id)
+    b, g = s.get("board_code"), s.get("grade")
+    if not b or not isinstance(g, int):
+        _cb_restart(cq, chat_id, msg_id, payload, user_id, username)
+        return
+    sel_codes = sorted(s.get("current_selection") or set())
+    if not sel_codes:
+        tg_async("answerCallbackQuery", {"callback_query_id": cq["id"], "text": "Please select at least one subject."})
+        return
+    selection = {
+        "board_code": b,
+        "grade": g,
+        "subjects": [CODE_TO_SUBJECT[c] for c in sel_codes],
+        "prefs": {}
+    }
+    s.setdefault("selections", []).append(selection)
+
+    push_event("selection", {
+        "user_id": user_id, "username": username,
+        "board": BOARD_CODES.get(b,b), "grade": g,
+        "subjects": selection["subjects"]
+    })
+
+    s["pref_flow"] = {
+        "sel_idx": len(s["selections"]) - 1,
+        "i": 0,
+        "subjects": selection["subjects"],
+        "current_mode": None
+    }
+    cur_subj = s["pref_flow"]["subjects"][0]
+    s["stage"] = "ask_mode_per_subject"
+    save_session(chat_id, s)
+    tg_edit_or_send(chat_id, msg_id,
+        f"🎯 Lesson type for <b>{h(cur_subj)}</b>?",
+        reply_markup=KB_MODE
+    )
+
+def _cb_mode(cq, chat_id, msg_id, payload, user_id, username):
+    mode = payload
+    s = session(chat_id)
+    pf = s.get("pref_flow")
+    if not pf:
+        tg_async("answerCallbackQuery", {"callback_query_id": cq["id"], "text": "No subject is pending."})
+        return
+
+    pf["current_mode"] = mode
+    cur_subj = pf["subjects"][pf["i"]]
+    s["stage"] = "ask_lpw_per_subject"
+    save_session(chat_id, s)
+    tg_edit_or_send(chat_id, msg_id,
+        f"🗓️ Lessons/week for <b>{h(cur_subj)}</b>?",
+        reply_markup=KB_LPW
+    )
+
+def _cb_lpw(cq, chat_id, msg_id, payload, user_id, username):
+    n = payload
+    s = session(chat_id)
+    pf = s.get("pref_flow")
+    if not pf:
+        tg_async("answerCallbackQuery", {"callback_query_id": cq["id"], "text": "No subject is pending."})
+        return
+
+    if not pf.get("current_mode"):
+        # crafted LPW| before MODE|; don't record a pref with mode=None
+        tg_async("answerCallbackQuery", {"callback_query_id": cq["id"], "text": "Pick lesson type first."})
+        return
+
+    n_int = {"1": 1, "2": 2}.get(n, 1)
+
+    sel = s["selections"][pf["sel_idx"]]
+    cur_subj = pf["subjects"][pf["i"]]
+    sel.setdefault("prefs", {})[cur_subj] = {"mode": pf["current_mode"], "lpw": n_int}
+    push_event("subject_pref", {
+        "user_id": user_id, "username": username,
+        "board": BOARD_CODES.get(sel["board_code"], sel["board_code"]),
+        "grade": sel["grade"],
+        "subject": cur_subj,
+        "mode": pf["current_mode"],
+        "lessons_per_week": n_int
+    })
+
+    # next or finish
+    pf["i"] += 1
+    if pf["i"] < len(pf["subjects"]):
+        next_subj = pf["subjects"][pf["i"]]
+        pf["current_mode"] = None
+        s["stage"] = "ask_mode_per_subject"
+        save_session(chat_id, s)
+        tg_edit_or_send(chat_id, msg_id,
+            f"🎯 Lesson type for <b>{h(next_subj)}</b>?",
+            reply_markup=KB_MODE
+        )
+    else:
+        s["pref_flow"] = None
+        s["stage"] = "flow"
+        save_session(chat_id, s)
+        tg_edit_or_send(chat_id, msg_id,
+            "Preferences saved ✅\nYou can add more selections or show tutors.",
+            reply_markup=kb_with_restart({
+                "inline_keyboard": [
+                    [{"text": "➕ Add more", "callback_data": "ADD_MORE"}],
+                    [{"text": "🚀 Show tutors", "callback_data": "SHOW_ALL"}]
+                ]
+            })
+        )
+
+def _cb_add_more(cq, chat_id, msg_id, payload, user_id, username):
+    tg_edit_or_send(chat_id, msg_id,
+        "🧭 <b>Step 1/3 – Board</b>\nChoose the board for the new selection:",
+        reply_markup=KB_BOARD
+    )
+
+def _cb_show_all(cq, chat_id, msg_id, payload, user_id, username):
+    s = session(chat_id)
+    selections = s.get("selections", [])
+    if not selections:
+        tg_async("answerCallbackQuery", {"callback_query_id": cq["id"], "text": "No selections yet."})
+        return
+
+    per_teacher_map: Dict[str, Dict[str, Any]] = {}
+    ordered_cards: List[Tuple[Dict[str, Any], Dict[str, Any]]] = []
+    seen_ids: Set[str] = set()
+
+    for sel in selections:
+        board_name_display = BOARD_CODES.get(sel["board_code"], sel["board_code"])
+        matches = _matches_cached(tuple(sorted(sel["subjects"])), sel["grade"], board_name_display)
+        for t in matches:
+            tid = t.get("id") or t["name"]
+            if tid not in seen_ids:
+                seen_ids.add(tid)
+                ordered_cards.append((t, sel))
+            entry = per_teacher_map.setdefault(tid, {"id": tid, "name": t["name"], "parts": []})
+            entry["parts"].append({
+                "subjects": sel["subjects"],
+                "board": board_name_display,
+                "grade": sel["grade"],
+                "prefs": sel.get("prefs", {})
+            })
+
+    # coalesce consecutive photo cards into albums (sendMediaGroup takes
+    # 2-10 items) so N teachers cost far fewer Telegram round-trips
+    units: List[Tuple[str, Any]] = []
+    photo_run: List[Dict[str, str]] = []
+
+    def _flush_run():
+        while len(photo_run) > 1:
+            units.append(("album", photo_run[:10]))
+            del photo_run[:10]
+        if photo_run:
+            units.append(("photo", photo_run.pop()))
+
+    for t, sel in ordered_cards:
+        caption = t.get("_caption_html") or _render_teacher_caption(t)
+        photo = t.get("photo_url")
+        if photo:
+            photo_run.append({"photo": photo, "caption": caption})
         else:
-            print("[UPDATE]", json.dumps(update)[:1200])
+            _flush_run()
+            units.append(("text", caption))
+    _flush_run()
+
+    def _send_unit(unit):
+        kind, body = unit
+        if kind == "album":
+            tg("sendMediaGroup", {"chat_id": chat_id, "media": [
+                {"type": "photo", "media": m["photo"], "caption": m["caption"], "parse_mode": "HTML"}
+                for m in body
+            ]})
+        elif kind == "photo":
+            tg("sendPhoto", {"chat_id": chat_id, "photo": body["photo"], "caption": body["caption"], "parse_mode": "HTML"})
+        else:
+            tg("sendMessage", {"chat_id": chat_id, "text": body, "parse_mode": "HTML"})
+
+    # fan the sends out in parallel instead of serial RTTs; this runs on
+    # EXECUTOR, so the children must go to the separate send pool
+    list(SEND_EXECUTOR.map(_send_unit, units))
+
+    s["last_matches"] = [{"id": v["id"], "name": v["name"]} for v in per_teacher_map.values()]
+    s["per_teacher_map"] = per_teacher_map
+    s["selected_teachers"] = set()
+    # keep the rendered keyboard so SEL_TEACHER taps only flip one button
+    s["kb_teachers"] = kb_with_restart(kb_select_teachers(s["last_matches"], s["selected_teachers"]))
+    save_session(chat_id, s)
+
+    tg("sendMessage", {
+        "chat_id": chat_id,
+        "text": "Select the tutors you're interested in, then press <b>📩 Send WhatsApp Link</b>.",
+        "parse_mode": "HTML",
+        "reply_markup": s["kb_teachers"]
+    })
+    push_event("show_tutors", {"user_id": user_id, "username": username})
+
+def _cb_sel_teacher(cq, chat_id, msg_id, payload, user_id, username):
+    tid = payload
+    s = session(chat_id)
+    matches = s.get("last_matches", [])
+    pos = next((i for i, m in enumerate(matches) if m["id"] == tid), None)
+    if pos is None:
+        # stale button from an earlier result set; nothing to edit
+        return
+    sel_ids = STORE.toggle_teacher(chat_id, s, tid)
+    kb = s.get("kb_teachers")
+    if kb:
+        tick = "✅" if tid in sel_ids else "☐"
+        kb["inline_keyboard"][pos][0] = {
+            "text": f"{tick} {matches[pos]['name']}",
+            "callback_data": f"SEL_TEACHER|{tid}"
+        }
+        save_session(chat_id, s)
+    else:
+        # session predates the cached keyboard; rebuild once
+        kb = kb_with_restart(kb_select_teachers(matches, sel_ids))
+    tg("editMessageReplyMarkup", {
+        "chat_id": chat_id,
+        "message_id": msg_id,
+        "reply_markup": kb
+    })
+
+def _cb_send_wa(cq, chat_id, msg_id, payload, user_id, username):
+    s = session(chat_id)
+    sel_ids: Set[str] = s.get("selected_teachers", set())
+    if not sel_ids:
+        tg_async("answerCallbackQuery", {"callback_query_id": cq["id"], "text": "Pick at least one tutor."})
+        return
 
+    per_teacher_map = s.get("per_teacher_map", {})
+    chosen = [per_teacher_map[tid] for tid in sel_ids if tid in per_teacher_map]
+
+    def fmt_pref(p):
+        if not p: return ""
+        m = "1:1" if p.get("mode") == "1:1" else ("Group" if p.get("mode") == "group" else None)
+        w = p.get("lpw")
+        parts = []
+        if m: parts.append(m)
+        if w: parts.append(f"{w}/wk")
+        return f" [{', '.join(parts)}]" if parts else ""
+
+    msg_lines = [f"Hello, this is {s.get('name','Student')}.\nI'm interested in the following:"]
+    for item in chosen:
+        name = item["name"]
+        sub_lines = []
+        for part in item["parts"]:
+            board = part["board"]
+            grade = part["grade"]
+            prefs = part.get("prefs", {})
+            subj_bits = []
+            for subj in part.get("subjects", []):
+                subj_bits.append(f"{subj}{fmt_pref(prefs.get(subj))}")
+            if subj_bits:
+                sub_lines.append(f"{', '.join(subj_bits)} - {board} Grade {grade}")
+        if sub_lines:
+            msg_lines.append(f"- {name} ({' | '.join(sub_lines)})")
+
+    msg_lines.append("Could you please share availability and fees?")
+    final_msg = "\n".join(msg_lines)
+
+    wa_link = build_wa_redirect_link(
+        user_id=user_id,
+        username=username,
+        teacher_id=None,
+        wa_number=PORTAL_WA_NUMBER,
+        prefill_text=final_msg
+    )
+    push_event("send_wa", {"user_id": user_id, "username": username, "selections": s.get("selections", [])})
+    tg("sendMessage", {
+        "chat_id": chat_id,
+        "text": f'<a href="{wa_link}">📩 Open WhatsApp</a>',
+        "parse_mode": "HTML",
+        "disable_web_page_preview": True,
+        "reply_markup": KB_RESTART_ONLY
+    })
+
+# Prefixed callbacks ("X|payload") dispatch on the prefix; bare commands
+# dispatch on the whole string.
+CB_HANDLERS = {
+    "B": _cb_board,
+    "G": _cb_grade,
+    "T": _cb_toggle,
+    "D": _cb_done,
+    "MODE": _cb_mode,
+    "LPW": _cb_lpw,
+    "SEL_TEACHER": _cb_sel_teacher,
+}
+CB_ACTIONS = {
+    "noop": _cb_noop,
+    "FORCE_RESTART": _cb_restart,
+    "ADD_MORE": _cb_add_more,
+    "SHOW_ALL": _cb_show_all,
+    "SEND_WA": _cb_send_wa,
+}
+
+def _process_update(update: Dict[str, Any]):
+    """Runs on EXECUTOR, after the webhook has already been acked."""
+    try:
         # ---------- Callback queries ----------
         if "callback_query" in update:
             cq = update["callback_query"]
             chat_id = cq["message"]["chat"]["id"]
             msg_id = cq["message"]["message_id"]
             data = cq.get("data", "")
-            tg("answerCallbackQuery", {"callback_query_id": cq["id"]})
+            tg_async("answerCallbackQuery", {"callback_query_id": cq["id"]})
 
             user_obj = cq.get("from", {}) or {}
             user_id = user_obj.get("id")
             username = user_obj.get("username") or ""
 
-            if data == "noop":
-                return jsonify({"ok": True})
-
-            # Restart
-            if data == "FORCE_RESTART":
-                SESSIONS[chat_id] = {"stage": "ask_name", "name": "", "selections": []}
-                tg("sendMessage", {
-                    "chat_id": chat_id,
-                    "text": "👋 Welcome to Kuwait IGCSE Portal!\nPlease type your full name (student):",
-                    "reply_markup": kb_with_restart({"inline_keyboard": []})
-                })
-                push_event("restart", {"user_id": user_id, "username": username})
-                return jsonify({"ok": True})
-
-            # Board
-            if data.startswith("B|"):
-                b = data.split("|", 1)[1]
-                s = session(chat_id)
-                s["board_code"] = b
-                push_event("board", {"user_id": user_id, "username": username, "board": BOARD_CODES.get(b,b)})
-
-                if isinstance(s.get("grade"), int):
-                    g = s["grade"]
-                    sel = set()
-                    tg_edit_or_send(chat_id, msg_id,
-                        summary_text(b, g, sel),
-                        reply_markup=kb_with_restart(kb_subjects(b, g, sel))
-                    )
-                    return jsonify({"ok": True})
-
-                tg_edit_or_send(chat_id, msg_id,
-                    "🔢 <b>Step 2/3 – Grade</b>\nSelect your current grade:",
-                    reply_markup=kb_with_restart(kb_grade(b))
-                )
-                return jsonify({"ok": True})
-
-            # Grade
-            if data.startswith("G|"):
-                _, g, b = data.split("|", 2)
-                g = int(g)
-                s = session(chat_id)
-                s["board_code"] = b
-                s["grade"] = g
-                sel = set()
-                push_event("grade", {"user_id": user_id, "username": username, "board": BOARD_CODES.get(b,b), "grade": g})
-                tg_edit_or_send(chat_id, msg_id,
-                    summary_text(b, g, sel),
-                    reply_markup=kb_with_restart(kb_subjects(b, g, sel))
-                )
-                return jsonify({"ok": True})
-
-            # Toggle subject
-            if data.startswith("T|"):
-                _, code, b, g, enc = data.split("|", 4)
-                g = int(g)
-                sel = decode_sel(enc)
-                if code == "__RESET__":
-                    sel = set()
-                else:
-                    if code in sel: sel.remove(code)
-                    else: sel.add(code)
-                tg_edit_or_send(chat_id, msg_id,
-                    summary_text(b, g, sel),
-                    reply_markup=kb_with_restart(kb_subjects(b, g, sel))
-                )
-                return jsonify({"ok": True})
-
-            # Done selecting subjects
-            if data.startswith("D|"):
-                _, b, g, enc = data.split("|", 3)
-                g = int(g)
-                sel_codes = [x for x in enc.split(".") if x]
-                if not sel_codes:
-                    tg("answerCallbackQuery", {"callback_query_id": cq["id"], "text": "Please select at least one subject."})
-                    return jsonify({"ok": True})
-
-                s = session(chat_id)
-                selection = {
-                    "board_code": b,
-                    "grade": g,
-                    "subjects": [CODE_TO_SUBJECT[c] for c in sel_codes],
-                    "prefs": {}
-                }
-                s.setdefault("selections", []).append(selection)
-
-                push_event("selection", {
-                    "user_id": user_id, "username": username,
-                    "board": BOARD_CODES.get(b,b), "grade": g,
-                    "subjects": selection["subjects"]
-                })
-
-                s["pref_flow"] = {
-                    "sel_idx": len(s["selections"]) - 1,
-                    "i": 0,
-                    "subjects": selection["subjects"],
-                    "current_mode": None
-                }
-                cur_subj = s["pref_flow"]["subjects"][0]
-                s["stage"] = "ask_mode_per_subject"
-                tg_edit_or_send(chat_id, msg_id,
-                    f"🎯 Lesson type for <b>{h(cur_subj)}</b>?",
-                    reply_markup=kb_mode()
-                )
-                return jsonify({"ok": True})
-
-            # MODE per subject
-            if data.startswith("MODE|"):
-                _, mode = data.split("|", 1)
-                s = session(chat_id)
-                pf = s.get("pref_flow")
-                if not pf:
-                    tg("answerCallbackQuery", {"callback_query_id": cq["id"], "text": "No subject is pending."})
-                    return jsonify({"ok": True})
-
-                pf["current_mode"] = mode
-                cur_subj = pf["subjects"][pf["i"]]
-                s["stage"] = "ask_lpw_per_subject"
-                tg_edit_or_send(chat_id, msg_id,
-                    f"🗓️ Lessons/week for <b>{h(cur_subj)}</b>?",
-                    reply_markup=kb_lpw()
-                )
-                return jsonify({"ok": True})
-
-            # LPW per subject
-            if data.startswith("LPW|"):
-                _, n = data.split("|", 1)
-                s = session(chat_id)
-                pf = s.get("pref_flow")
-                if not pf:
-                    tg("answerCallbackQuery", {"callback_query_id": cq["id"], "text": "No subject is pending."})
-                    return jsonify({"ok": True})
-
-                try:
-                    n_int = int(n)
-                    if n_int not in (1, 2):
-                        n_int = 1
-                except:
-                    n_int = 1
-
-                sel = s["selections"][pf["sel_idx"]]
-                cur_subj = pf["subjects"][pf["i"]]
-                sel.setdefault("prefs", {})[cur_subj] = {"mode": pf["current_mode"], "lpw": n_int}
-                push_event("subject_pref", {
-                    "user_id": user_id, "username": username,
-                    "board": BOARD_CODES.get(sel["board_code"], sel["board_code"]),
-                    "grade": sel["grade"],
-                    "subject": cur_subj,
-                    "mode": pf["current_mode"],
-                    "lessons_per_week": n_int
-                })
-
-                # next or finish
-                pf["i"] += 1
-                if pf["i"] < len(pf["subjects"]):
-                    next_subj = pf["subjects"][pf["i"]]
-                    pf["current_mode"] = None
-                    s["stage"] = "ask_mode_per_subject"
-                    tg_edit_or_send(chat_id, msg_id,
-                        f"🎯 Lesson type for <b>{h(next_subj)}</b>?",
-                        reply_markup=kb_mode()
-                    )
-                    return jsonify({"ok": True})
-                else:
-                    s["pref_flow"] = None
-                    s["stage"] = "flow"
-                    tg_edit_or_send(chat_id, msg_id,
-                        "Preferences saved ✅\nYou can add more selections or show tutors.",
-                        reply_markup=kb_with_restart({
-                            "inline_keyboard": [
-                                [{"text": "➕ Add more", "callback_data": "ADD_MORE"}],
-                                [{"text": "🚀 Show tutors", "callback_data": "SHOW_ALL"}]
-                            ]
-                        })
-                    )
-                    return jsonify({"ok": True})
-
-            # Add more
-            if data == "ADD_MORE":
-                tg_edit_or_send(chat_id, msg_id,
-                    "🧭 <b>Step 1/3 – Board</b>\nChoose the board for the new selection:",
-                    reply_markup=kb_with_restart(kb_board())
-                )
-                return jsonify({"ok": True})
-
-            # Show all tutors
-            if data == "SHOW_ALL":
-                s = session(chat_id)
-                selections = s.get("selections", [])
-                if not selections:
-                    tg("answerCallbackQuery", {"callback_query_id": cq["id"], "text": "No selections yet."})
-                    return jsonify({"ok": True})
-
-                per_teacher_map: Dict[str, Dict[str, Any]] = {}
-                ordered_cards: List[Tuple[Dict[str, Any], Dict[str, Any]]] = []
-
-                for sel in selections:
-                    board_name_display = BOARD_CODES.get(sel["board_code"], sel["board_code"])
-                    matches = collect_best_matches(sel["subjects"], sel["grade"], board_name_display, k=4)
-                    for t in matches:
-                        tid = t.get("id") or t["name"]
-                        if not any((t2.get("id") or t2["name"]) == tid for (t2, _) in ordered_cards):
-                            ordered_cards.append((t, sel))
-                        entry = per_teacher_map.setdefault(tid, {"id": tid, "name": t["name"], "parts": []})
-                        entry["parts"].append({
-                            "subjects": sel["subjects"],
-                            "board": board_name_display,
-                            "grade": sel["grade"],
-                            "prefs": sel.get("prefs", {})
-                        })
-
-                student_name = s.get("name") or "Student"
-                for t, sel in ordered_cards:
-                    caption = format_teacher_caption_html(
-                        t, student_name,
-                        BOARD_CODES.get(sel["board_code"], sel["board_code"]),
-                        sel["grade"],
-                        sel["subjects"]
-                    )
-                    photo = t.get("photo_url")
-                    if photo:
-                        tg("sendPhoto", {"chat_id": chat_id, "photo": photo, "caption": caption, "parse_mode": "HTML"})
-                    else:
-                        tg("sendMessage", {"chat_id": chat_id, "text": caption, "parse_mode": "HTML"})
-
-                s["last_matches"] = [{"id": v["id"], "name": v["name"]} for v in per_teacher_map.values()]
-                s["per_teacher_map"] = per_teacher_map
-                s["selected_teachers"] = set()
-
-                tg("sendMessage", {
-                    "chat_id": chat_id,
-                    "text": "Select the tutors you're interested in, then press <b>📩 Send WhatsApp Link</b>.",
-                    "parse_mode": "HTML",
-                    "reply_markup": kb_with_restart(kb_select_teachers(s["last_matches"], s["selected_teachers"]))
-                })
-                push_event("show_tutors", {"user_id": user_id, "username": username})
-                return jsonify({"ok": True})
-
-            # Toggle teacher selection
-            if data.startswith("SEL_TEACHER|"):
-                _, tid = data.split("|", 1)
-                s = session(chat_id)
-                sel_ids: Set[str] = s.setdefault("selected_teachers", set())
-                if tid in sel_ids: sel_ids.remove(tid)
-                else: sel_ids.add(tid)
-                rows = kb_select_teachers(s.get("last_matches", []), sel_ids)
-                tg("editMessageReplyMarkup", {
-                    "chat_id": chat_id,
-                    "message_id": msg_id,
-                    "reply_markup": kb_with_restart(rows)
-                })
-                return jsonify({"ok": True})
-
-            # Send WhatsApp
-            if data == "SEND_WA":
-                s = session(chat_id)
-                sel_ids: Set[str] = s.get("selected_teachers", set())
-                if not sel_ids:
-                    tg("answerCallbackQuery", {"callback_query_id": cq["id"], "text": "Pick at least one tutor."})
-                    return jsonify({"ok": True})
-
-                per_teacher_map = s.get("per_teacher_map", {})
-                chosen = [per_teacher_map[tid] for tid in sel_ids if tid in per_teacher_map]
-
-                def fmt_pref(p):
-                    if not p: return ""
-                    m = "1:1" if p.get("mode") == "1:1" else ("Group" if p.get("mode") == "group" else None)
-                    w = p.get("lpw")
-                    parts = []
-                    if m: parts.append(m)
-                    if w: parts.append(f"{w}/wk")
-                    return f" [{', '.join(parts)}]" if parts else ""
-
-                msg_lines = [f"Hello, this is {s.get('name','Student')}.\nI'm interested in the following:"]
-                for item in chosen:
-                    name = item["name"]
-                    sub_lines = []
-                    for part in item["parts"]:
-                        board = part["board"]
-                        grade = part["grade"]
-                        prefs = part.get("prefs", {})
-                        subj_bits = []
-                        for subj in part.get("subjects", []):
-                            subj_bits.append(f"{subj}{fmt_pref(prefs.get(subj))}")
-                        if subj_bits:
-                            sub_lines.append(f"{', '.join(subj_bits)} - {board} Grade {grade}")
-                    if sub_lines:
-                        msg_lines.append(f"- {name} ({' | '.join(sub_lines)})")
-
-                msg_lines.append("Could you please share availability and fees?")
-                final_msg = "\n".join(msg_lines)
-
-                wa_link = build_wa_redirect_link(
-                    user_id=user_id,
-                    username=username,
-                    teacher_id=None,
-                    wa_number=PORTAL_WA_NUMBER,
-                    prefill_text=final_msg
-                )
-                push_event("send_wa", {"user_id": user_id, "username": username, "selections": s.get("selections", [])})
-                tg("sendMessage", {
-                    "chat_id": chat_id,
-                    "text": f'<a href="{wa_link}">📩 Open WhatsApp</a>',
-                    "parse_mode": "HTML",
-                    "disable_web_page_preview": True,
-                    "reply_markup": kb_with_restart({"inline_keyboard": []})
-                })
-                return jsonify({"ok": True})
-
-            return jsonify({"ok": True})
+            prefix, sep, payload = data.partition("|")
+            fn = CB_HANDLERS.get(prefix) if sep else CB_ACTIONS.get(data)
+            if fn:
+                fn(cq, chat_id, msg_id, payload, user_id, username)
+            return
 
         # ---------- Normal messages ----------
         msg = update.get("message") or update.get("edited_message")
         if not msg:
-            return jsonify({"ok": True})
+            return
 
         chat_id = msg["chat"]["id"]
         text = (msg.get("text") or "").strip()
@@ -818,37 +1203,61 @@ def _handle_webhook():
         user_id = u.get("id"); username = u.get("username") or ""
 
         if text.lower() in ("/start", "start"):
-            SESSIONS[chat_id] = {"stage": "ask_name", "name": "", "selections": []}
+            save_session(chat_id, {"stage": "ask_name", "name": "", "selections": []})
             tg("sendMessage", {
                 "chat_id": chat_id,
                 "text": "👋 Welcome to Kuwait IGCSE Portal!\nPlease type your full name (student):",
-                "reply_markup": kb_with_restart({"inline_keyboard": []})
+                "reply_markup": KB_RESTART_ONLY
             })
             push_event("session_start", {"user_id": user_id, "username": username})
-            return jsonify({"ok": True})
+            return
 
         if s.get("stage") == "ask_name" and text:
             s["name"] = text
             s["stage"] = "flow"
+            save_session(chat_id, s)
             tg("sendMessage", {
                 "chat_id": chat_id,
                 "text": "🧭 <b>Step 1/3 – Board</b>\nChoose the board:",
                 "parse_mode": "HTML",
-                "reply_markup": kb_with_restart(kb_board())
+                "reply_markup": KB_BOARD
             })
-            return jsonify({"ok": True})
+            return
 
         tg("sendMessage", {
             "chat_id": chat_id,
             "text": "Please use the options below to continue 👇",
-            "reply_markup": kb_with_restart(kb_board())
+            "reply_markup": KB_BOARD
         })
-        return jsonify({"ok": True})
+        return
 
-    except Exception as e:
-        print("[ERR]", repr(e))
-        print(traceback.format_exc())
-        return jsonify({"ok": True}), 200
+    except Exception:
+        log.exception("[ERR] update processing failed")
+
+def _handle_webhook():
+    # Ack Telegram immediately; all tg() round-trips happen off the
+    # request thread so delivery never backs up behind our own sends.
+    if not _check_telegram_secret():
+        return jsonify(ok=False, error="forbidden"), 403
+    try:
+        update = orjson.loads(request.get_data())
+    except Exception:
+        update = None
+    if not isinstance(update, dict):
+        update = {}
+    # Telegram retries the same update_id on timeouts; don't redo side effects
+    upd_id = update.get("update_id")
+    if upd_id is not None and STORE.seen_update(upd_id):
+        push_event("dup_update", {"update_id": upd_id})
+        return OK_RESPONSE
+    if LOG_RAW_UPDATES:
+        # admin_log sends through tg() and its rate buckets; never let
+        # that block the ack
+        SEND_EXECUTOR.submit(admin_log, "RAW UPDATE: " + orjson.dumps(update)[:3500].decode(errors="replace"))
+    elif app.debug:
+        log.debug("[UPDATE] %s", orjson.dumps(update)[:1200].decode(errors="replace"))
+    EXECUTOR.submit(_process_update, update)
+    return OK_RESPONSE
 
 # Vercel entrypoint
 @app.post("/api/webhook")